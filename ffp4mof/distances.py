@@ -0,0 +1,27 @@
+from numpy import array, ascontiguousarray, lexsort, ones
+from pymatgen.optimization.neighbors import find_points_in_spheres
+
+
+def get_neighbor_pairs(frac_coords, lattice_matrix, cutoff):
+    lattice_matrix = ascontiguousarray(lattice_matrix, dtype=float)
+    cart_coords = ascontiguousarray(frac_coords @ lattice_matrix, dtype=float)
+
+    i, j, _, d = find_points_in_spheres(
+        cart_coords,
+        cart_coords,
+        r=float(cutoff),
+        pbc=array([1, 1, 1], dtype=int),
+        lattice=lattice_matrix,
+        tol=1e-8,
+    )
+
+    not_self = i != j
+    i, j, d = i[not_self], j[not_self], d[not_self]
+
+    # in small cells several images of a site lie within the cutoff, keep the shortest one
+    order = lexsort((d, j, i))
+    i, j, d = i[order], j[order], d[order]
+    first = ones(len(i), dtype=bool)
+    first[1:] = (i[1:] != i[:-1]) | (j[1:] != j[:-1])
+
+    return i[first], j[first], d[first]
@@ -1,106 +1,210 @@
 from os.path import join, dirname, abspath
-from itertools import combinations
 from json import load
 from pandas import read_csv
-from numpy import array, vstack, hstack
-from numpy import zeros, fill_diagonal, where
+from numpy import array, cumsum
+from numpy import empty, flatnonzero, float32, full, isnan, nan, ones, searchsorted, uint64, zeros
+from numba import njit, prange
+from scipy.sparse import csr_matrix
+from joblib import Parallel, delayed
 from pymatgen.core.periodic_table import Element
 from ase.io import read
-from ase.data import atomic_numbers, covalent_radii, cccbdb_ip
-from matminer.featurizers.site import CrystalNNFingerprint, AGNIFingerprints, OPSiteFingerprint
-
-from ffp4mof.matfeaturizers import VoronoiModifiedFingerprint
-
-
-def get_op_site_fingerprints(structure):
-    opsite = OPSiteFingerprint()
-    opsite_fingerprints = vstack([opsite.featurize(structure, i) for i in range(len(structure))])
+from ase.data import covalent_radii, cccbdb_ip
+from matminer.featurizers.site import AGNIFingerprints, OPSiteFingerprint
+
+from ffp4mof.distances import get_neighbor_pairs
+from ffp4mof.matfeaturizers import CrystalNNModifiedFingerprint, VoronoiModifiedFingerprint
+
+
+_OPSITE = OPSiteFingerprint()
+_AGNI = AGNIFingerprints(directions=(None,))
+_CNN = CrystalNNModifiedFingerprint.from_preset('cn')
+_VORO = VoronoiModifiedFingerprint()
+# bump whenever get_features output changes, so cached features are recomputed
+FEATURES_FORMAT = 1
+_SITE_DESCRS_WIDTH = 10
+_FEATURE_WIDTHS = (
+    len(_AGNI.feature_labels()),
+    len(_CNN.feature_labels()),
+    _SITE_DESCRS_WIDTH,
+    len(_OPSITE.feature_labels()),
+    len(_VORO.feature_labels()),
+)
+
+
+def _featurize_sites(featurizer, structure, n_jobs=1, prefer="threads", out=None):
+    first_fingerprint = featurizer.featurize(structure, 0)
+    fingerprints = empty((len(structure), len(first_fingerprint))) if out is None else out
+    fingerprints[0] = first_fingerprint
+
+    if n_jobs == 1:
+        for i in range(1, len(structure)):
+            fingerprints[i] = featurizer.featurize(structure, i)
+    else:
+        rows = Parallel(n_jobs=n_jobs, prefer=prefer, batch_size="auto")(
+            delayed(featurizer.featurize)(structure, i) for i in range(1, len(structure))
+        )
+        for i, row in enumerate(rows, start=1):
+            fingerprints[i] = row
+
+    return fingerprints
+
+
+def get_op_site_fingerprints(structure, n_jobs=1, out=None):
+    # the order parameters keep trigonometric scratch arrays on the featurizer instance,
+    # so sites are split over processes, each with its own copy, rather than threads
+    opsite_fingerprints = _featurize_sites(_OPSITE, structure, n_jobs=n_jobs, prefer="processes", out=out)
     return opsite_fingerprints
 
 
 def get_voronoi_fingerprints(structure):
-    voronoi_fingerprints = array(VoronoiModifiedFingerprint().featurize_structure(structure))
+    voronoi_fingerprints = array(_VORO.featurize_structure(structure))
     return voronoi_fingerprints
 
 
-def get_agni_fingerprints(structure):
-    agni = AGNIFingerprints(directions=(None,))
-    agni_fingerprints = vstack([agni.featurize(structure, i) for i in range(len(structure))])
+def get_agni_fingerprints(structure, n_jobs=1, out=None):
+    # featurize is pure Python over small per-site arrays and holds the GIL, so threads cannot help
+    agni_fingerprints = _featurize_sites(_AGNI, structure, n_jobs=n_jobs, prefer="processes", out=out)
     return agni_fingerprints
 
 
 def get_crystal_nn_fingerprints(structure):
-    crystal_nn = CrystalNNFingerprint.from_preset('cn')
-    crystal_nn_fingerprints = vstack([crystal_nn.featurize(structure, i) for i in range(len(structure))])
+    crystal_nn_fingerprints = array(_CNN.featurize_structure(structure))
     return crystal_nn_fingerprints
 
 
-def get_adj_dist_matrices(structure, tol=0.5):
-    dist_matrix = structure.distance_matrix
-    adj_matrix = zeros(dist_matrix.shape)
-    sites = [site for site in structure]
-
-    for i, j in combinations(range(len(structure)), 2):
-        if dist_matrix[i][j] < 6.1:
-            element_1 = Element(sites[i].specie.symbol)
-            element_2 = Element(sites[j].specie.symbol)
-            
-            max_distance = covalent_radii[atomic_numbers[element_1.symbol]] + \
-            covalent_radii[atomic_numbers[element_2.symbol]] + tol
-                
-            if dist_matrix[i][j] < max_distance:
-                adj_matrix[i][j] = 1
-                adj_matrix[j][i] = 1
+def _get_dist_matrix(structure, radii, tol):
+    n_sites = len(structure)
 
-    fill_diagonal(adj_matrix, 0)
+    # second sphere neighbors are at most two bonds away, so their distances are needed as well
+    max_bond_distance = min(2 * radii.max() + tol, 6.1)
+    i, j, d = get_neighbor_pairs(structure.frac_coords, structure.lattice.matrix, 2 * max_bond_distance)
+    dist_matrix = csr_matrix((d, (i, j)), shape=(n_sites, n_sites))
+    dist_matrix.sort_indices()
 
-    return array(adj_matrix, dtype=int), dist_matrix
+    return dist_matrix
 
 
-def get_site_descrs(structure):
-    adj, dist = get_adj_dist_matrices(structure)
-    ionization_energies = [Element.from_Z(z).ionization_energy for z in structure.atomic_numbers]
-    electronegativities = [ELECTRONEGATIVITIES_DICT[str(z)] for z in structure.atomic_numbers]
+def get_adj_dist_matrices(structure, tol=0.5):
+    """
+    Sparse adjacency and distance matrices of the structure sites.
+    Returns:
+        adj_matrix (csr_matrix of int): 1 for bonded site pairs, i.e. closer than
+            the sum of covalent radii + tol (and 6.1 A).
+        dist_matrix (csr_matrix of float): minimum image distances, stored only for
+            pairs within twice the largest possible bond length. Pairs further apart
+            are not stored and read as 0.0, so only the stored entries
+            (dist_matrix.nonzero() or .tocoo()) are distances; it is not a drop-in
+            replacement for structure.distance_matrix.
+    """
+    radii = covalent_radii[array(structure.atomic_numbers)]
+    dist_matrix = _get_dist_matrix(structure, radii, tol)
+
+    dist = dist_matrix.tocoo()
+    bonded = (dist.data < radii[dist.row] + radii[dist.col] + tol) & (dist.data < 6.1)
+    adj_matrix = csr_matrix((ones(bonded.sum(), dtype=int), (dist.row[bonded], dist.col[bonded])), shape=dist.shape)
+
+    return adj_matrix, dist_matrix
+
+
+@njit(parallel=True, fastmath={"reassoc", "contract"}, error_model="numpy", cache=True)
+def _site_descrs_kernel(indptr, indices, dists, radii, ionization_energies, electronegativities, tol):
+    n_sites = radii.shape[0]
+    site_descrs = empty((n_sites, 10))
+
+    for i in prange(n_sites):
+        start, end = indptr[i], indptr[i + 1]
+
+        # bitset of the site itself and its first and second sphere neighbors, 64 sites per word
+        visited = zeros((n_sites + 63) >> 6, uint64)
+        visited[i >> 6] |= uint64(1) << uint64(i & 63)
+
+        n_first, ie_first, en_first, dist_first = 0, 0.0, 0.0, 0.0
+        for p in range(start, end):
+            j = indices[p]
+            if dists[p] < min(radii[i] + radii[j] + tol, 6.1):
+                visited[j >> 6] |= uint64(1) << uint64(j & 63)
+                n_first += 1
+                ie_first += ionization_energies[j]
+                en_first += electronegativities[j]
+                dist_first += dists[p]
+
+        n_second, ie_second, en_second, dist_second = 0, 0.0, 0.0, 0.0
+        for p in range(start, end):
+            j = indices[p]
+            if dists[p] >= min(radii[i] + radii[j] + tol, 6.1):
+                continue
+            for q in range(indptr[j], indptr[j + 1]):
+                k = indices[q]
+                bit = uint64(1) << uint64(k & 63)
+                if visited[k >> 6] & bit == 0 and dists[q] < min(radii[j] + radii[k] + tol, 6.1):
+                    visited[k >> 6] |= bit
+                    n_second += 1
+                    ie_second += ionization_energies[k]
+                    en_second += electronegativities[k]
+                    dist_second += dists[start + searchsorted(indices[start:end], k)]
+
+        site_descrs[i, 0] = ionization_energies[i]
+        site_descrs[i, 1] = electronegativities[i]
+        site_descrs[i, 2] = n_first
+        site_descrs[i, 3] = ie_first / n_first
+        site_descrs[i, 4] = en_first / n_first
+        site_descrs[i, 5] = dist_first / n_first
+        site_descrs[i, 6] = n_second
+        site_descrs[i, 7] = ie_second / n_second
+        site_descrs[i, 8] = en_second / n_second
+        site_descrs[i, 9] = dist_second / n_second
 
-    site_descrs = []
+    return site_descrs
 
-    for i in range(len(structure)):
-        zero_sphere, first_sphere, second_sphere = [], [], []
 
-        zero_sphere.append(ionization_energies[i])
-        zero_sphere.append(electronegativities[i])
+def get_site_descrs(structure, tol=0.5):
+    radii = covalent_radii[array(structure.atomic_numbers)]
+    dist = _get_dist_matrix(structure, radii, tol)
+    ionization_energies = _IE_TABLE[array(structure.atomic_numbers)]
+    electronegativities = _EN_TABLE[array(structure.atomic_numbers)]
 
-        first_neighbors = where(adj[i] > 0)[0].tolist()
-        first_sphere.append(len(first_neighbors))
-        first_sphere.append(sum([ionization_energies[n] for n in first_neighbors]) / len(first_neighbors))
-        first_sphere.append(sum([electronegativities[n] for n in first_neighbors]) / len(first_neighbors))
-        first_sphere.append(sum([dist[i][n] for n in first_neighbors]) / len(first_neighbors))
+    unsupported = isnan(electronegativities) | isnan(ionization_energies)
+    if unsupported.any():
+        symbols = sorted({site.specie.symbol for site, missing in zip(structure, unsupported) if missing})
+        raise ValueError(f"no electronegativity or ionization energy data for {', '.join(symbols)}")
 
-        second_neighbors = set(hstack([where(adj[n] > 0)[0].tolist() for n in first_neighbors]).tolist())
-        second_neighbors = list(second_neighbors - set(first_neighbors) - set([i]))
-        second_sphere.append(len(second_neighbors))
-        second_sphere.append(sum([ionization_energies[n] for n in second_neighbors]) / len(second_neighbors))
-        second_sphere.append(sum([electronegativities[n] for n in second_neighbors]) / len(second_neighbors))
-        second_sphere.append(sum([dist[i][n] for n in second_neighbors]) / len(second_neighbors))
+    site_descrs = _site_descrs_kernel(
+        dist.indptr, dist.indices, dist.data, radii, ionization_energies, electronegativities, tol
+    )
 
-        all_spheres = zero_sphere + first_sphere + second_sphere
-        site_descrs.append(all_spheres)
+    # the sphere means are undefined for sites without bonded first or second sphere neighbors
+    isolated = (site_descrs[:, 2] == 0) | (site_descrs[:, 6] == 0)
+    if isolated.any():
+        raise ValueError(
+            f"sites {flatnonzero(isolated).tolist()} have no bonded first or second sphere neighbors"
+        )
 
-    site_descrs = array(site_descrs)
     return site_descrs
 
 
-def get_features(structure):
-    features = hstack((
-        get_agni_fingerprints(structure),
-        get_crystal_nn_fingerprints(structure),
-        get_site_descrs(structure),
-        get_op_site_fingerprints(structure),
-        get_voronoi_fingerprints(structure),
-    ))
-    
+def get_features(structure, n_jobs=1):
+    # fingerprints are reduced in float64 and written into column blocks of one float32 matrix
+    # for the scalers and models
+    features = empty((len(structure), sum(_FEATURE_WIDTHS)), dtype=float32)
+    bounds = cumsum((0,) + _FEATURE_WIDTHS)
+    agni, crystal_nn, site_descrs, opsite, voronoi = (
+        features[:, start:end] for start, end in zip(bounds[:-1], bounds[1:])
+    )
+
+    get_agni_fingerprints(structure, n_jobs=n_jobs, out=agni)
+    crystal_nn[:] = get_crystal_nn_fingerprints(structure)
+    site_descrs[:] = get_site_descrs(structure)
+    get_op_site_fingerprints(structure, n_jobs=n_jobs, out=opsite)
+    voronoi[:] = get_voronoi_fingerprints(structure)
+
     return features
 
 
 with open(join(dirname(abspath(__file__)), "electronegativities.json")) as json_file:
     ELECTRONEGATIVITIES_DICT = load(json_file)
+
+_EN_TABLE = full(119, nan)
+_IE_TABLE = full(119, nan)
+for z, electronegativity in ELECTRONEGATIVITIES_DICT.items():
+    _EN_TABLE[int(z)] = electronegativity
+    _IE_TABLE[int(z)] = Element.from_Z(int(z)).ionization_energy
@@ -47,11 +47,33 @@ software, distribute, and sublicense such enhancements or derivative
 works thereof, in binary and source code form.
 """
 
-from numpy import zeros, concatenate
-from pymatgen.analysis.local_env import VoronoiNN
+import copy
+import warnings
+from math import cos, isnan, pi, sqrt
+
+from numpy import bincount, concatenate, fromiter
+from numpy import mean, std, amin, amax
+from numpy.linalg import norm
+from pymatgen.analysis.local_env import VoronoiNN, CrystalNN, _get_radius, _get_default_radius
 from matminer.featurizers.base import BaseFeaturizer
+from matminer.featurizers.site import CrystalNNFingerprint
 from matminer.featurizers.utils.stats import PropertyStats
-from matminer.utils.caching import get_all_nearest_neighbors
+
+
+# numpy equivalents of the PropertyStats statistics used by default
+NUMPY_STATS = {
+    'mean': mean,
+    'std_dev': std,
+    'minimum': amin,
+    'maximum': amax,
+}
+
+
+def _calc_stat(data, stat):
+    if stat in NUMPY_STATS:
+        return NUMPY_STATS[stat](data)
+    return PropertyStats.calc_stat(data, stat)
+
 
 class VoronoiModifiedFingerprint(BaseFeaturizer):
     """
@@ -99,12 +121,21 @@ class VoronoiModifiedFingerprint(BaseFeaturizer):
         stats_vol (list of str): volume statistics types.
         stats_area (list of str): area statistics types.
         stats_dist (list of str): neighboring distance statistics types.
+        voronoi_tol (float): VoronoiNN tolerance, facets with solid angle
+                             smaller than this fraction of the largest one
+                             are discarded. (default: 0)
+        area_tol (float): facets with area smaller than this fraction of
+                          the mean facet area of the site are discarded.
+                          (default: 0)
     """
 
     def __init__(self, cutoff=6.5,
                  use_symm_weights=False, symm_weights='solid_angle',
-                 stats_vol=None, stats_area=None, stats_dist=None):
+                 stats_vol=None, stats_area=None, stats_dist=None,
+                 voronoi_tol=0, area_tol=0):
         self.cutoff = cutoff
+        self.voronoi_tol = voronoi_tol
+        self.area_tol = area_tol
         self.use_symm_weights = use_symm_weights
         self.symm_weights = symm_weights
         self.stats_vol = ['mean', 'std_dev', 'minimum', 'maximum'] \
@@ -114,12 +145,12 @@ class VoronoiModifiedFingerprint(BaseFeaturizer):
         self.stats_dist = ['mean', 'std_dev', 'minimum', 'maximum'] \
             if stats_dist is None else copy.deepcopy(stats_dist)
 
-    def featurize(self, n_w):
+    def featurize(self, facets):
         """
-        Get Voronoi fingerprints of site with given index in input structure.
+        Get Voronoi fingerprints of site from its Voronoi polyhedron.
         Args:
-            struct (Structure): Pymatgen Structure object.
-            idx (int): index of target site in structure.
+            facets (list of dict): facet statistics of the target site, as
+                returned by VoronoiNN.get_all_voronoi_polyhedra.
         Returns:
             (list of floats): Voronoi fingerprints.
                 -Voronoi indices
@@ -132,47 +163,54 @@ class VoronoiModifiedFingerprint(BaseFeaturizer):
                 -Voronoi dist statistics
         """
 
-        # Prepare storage for the Voronoi indices
-        voro_idx_list = zeros(8, int)
-        voro_idx_weights = zeros(8)
-        vol_list = []
-        area_list = []
-        dist_list = []
-
-        # Get statistics
-        for nn in n_w:
-            if nn['poly_info']['n_verts'] <= 10:
-                # If a facet has more than 10 edges, it's skipped here.
-                voro_idx_list[nn['poly_info']['n_verts'] - 3] += 1
-                vol_list.append(nn['poly_info']['volume'])
-                area_list.append(nn['poly_info']['area'])
-                dist_list.append(nn['poly_info']['face_dist'] * 2)
-                if self.use_symm_weights:
-                    voro_idx_weights[nn['poly_info']['n_verts'] - 3] += \
-                        nn['poly_info'][self.symm_weights]
-
-        symm_idx_list = voro_idx_list / sum(voro_idx_list)
+        # Keep the facets VoronoiNN.get_nn_info would report as neighbors
+        max_angle = max(f['solid_angle'] for f in facets)
+        poly_info = [f for f in facets if f['solid_angle'] > self.voronoi_tol * max_angle]
+
+        # Collect facet statistics into arrays
+        n_verts = fromiter((p['n_verts'] for p in poly_info), int, len(poly_info))
+        vol_list = fromiter((p['volume'] for p in poly_info), float, len(poly_info))
+        area_list = fromiter((p['area'] for p in poly_info), float, len(poly_info))
+        dist_list = fromiter((p['face_dist'] for p in poly_info), float, len(poly_info)) * 2
+
+        # If a facet has more than 10 edges, it's skipped here.
+        mask = n_verts <= 10
+        if self.area_tol > 0:
+            # Small spurious facets are skipped as well.
+            mask &= area_list >= self.area_tol * area_list.mean()
+        n_verts = n_verts[mask]
+        vol_list, area_list, dist_list = vol_list[mask], area_list[mask], dist_list[mask]
+
+        # Get the Voronoi indices
+        voro_idx_list = bincount(n_verts - 3, minlength=8)
+        symm_idx_list = voro_idx_list / voro_idx_list.sum()
         if self.use_symm_weights:
-            symm_wt_list = voro_idx_weights / sum(voro_idx_weights)
+            weights = fromiter((p[self.symm_weights] for p in poly_info), float, len(poly_info))[mask]
+            voro_idx_weights = bincount(n_verts - 3, weights=weights, minlength=8)
+            symm_wt_list = voro_idx_weights / voro_idx_weights.sum()
             voro_fps = list(concatenate((voro_idx_list, symm_idx_list,
                                            symm_wt_list), axis=0))
         else:
             voro_fps = list(concatenate((voro_idx_list,
                                            symm_idx_list), axis=0))
 
-        voro_fps.append(sum(vol_list))
-        voro_fps.append(sum(area_list))
-        voro_fps += [PropertyStats().calc_stat(vol_list, stat_vol)
+        voro_fps.append(vol_list.sum())
+        voro_fps.append(area_list.sum())
+        voro_fps += [_calc_stat(vol_list, stat_vol)
                      for stat_vol in self.stats_vol]
-        voro_fps += [PropertyStats().calc_stat(area_list, stat_area)
+        voro_fps += [_calc_stat(area_list, stat_area)
                      for stat_area in self.stats_area]
-        voro_fps += [PropertyStats().calc_stat(dist_list, stat_dist)
+        voro_fps += [_calc_stat(dist_list, stat_dist)
                      for stat_dist in self.stats_dist]
         return voro_fps
     
     def featurize_structure(self, struct):
-        n_w = get_all_nearest_neighbors(VoronoiNN(cutoff=self.cutoff, allow_pathological=True), struct)
-        features = [self.featurize(n_w[i]) for i in range(len(struct.sites))]
+        # The polyhedra are used directly: the neighbor info built around them
+        # (site images, original site indices, adjacent facets) is not needed here
+        voronoi_nn = VoronoiNN(cutoff=self.cutoff, allow_pathological=True,
+                               compute_adj_neighbors=False)
+        all_polyhedra = voronoi_nn.get_all_voronoi_polyhedra(struct)
+        features = [self.featurize(list(polyhedron.values())) for polyhedron in all_polyhedra]
         return features
 
     def feature_labels(self):
@@ -216,3 +254,188 @@ class VoronoiModifiedFingerprint(BaseFeaturizer):
 
     def implementors(self):
         return ['Qi Wang']
+
+
+class StructureCrystalNN(CrystalNN):
+    """
+    CrystalNN that computes the near neighbor data of all sites in a
+    structure from a single Voronoi tessellation.
+
+    CrystalNN.get_nn_data runs a separate tessellation around every site.
+    get_all_nn_data tessellates the whole structure once with
+    VoronoiNN.get_all_nn_info and then applies the CrystalNN weighting
+    (adapted from pymatgen's CrystalNN.get_nn_data) to each site. If the
+    tessellation fails, or cation_anion is set (bond targets then depend
+    on the site), it falls back to the site-by-site method.
+    """
+
+    def get_all_nn_data(self, structure, length=None):
+        """
+        Args:
+            structure: (Structure) enclosing structure object
+            length: (int) if set, will return a fixed range of CN numbers
+
+        Returns:
+            list of NNData namedtuples, one per site, see get_nn_data
+        """
+        if self.cation_anion:
+            return [self.get_nn_data(structure, n, length) for n in range(len(structure))]
+
+        vnn = VoronoiNN(weight="solid_angle", cutoff=self.search_cutoff)
+        try:
+            all_nn = vnn.get_all_nn_info(structure)
+        except (RuntimeError, ValueError):
+            # the site-by-site search enlarges the cutoff until the tessellation succeeds
+            return [self.get_nn_data(structure, n, length) for n in range(len(structure))]
+
+        return [self._weigh_nn_data(structure, n, nn, length) for n, nn in enumerate(all_nn)]
+
+    def _weigh_nn_data(self, structure, n, nn, length=None):
+        length = length or self.fingerprint_length
+
+        # solid angle weights can be misleading in open / porous structures
+        # adjust weights to correct for this behavior
+        if self.porous_adjustment:
+            for x in nn:
+                x["weight"] *= x["poly_info"]["solid_angle"] / x["poly_info"]["area"]
+
+        # adjust solid angle weight based on electronegativity difference
+        if self.x_diff_weight > 0:
+            for entry in nn:
+                X1 = structure[n].specie.X
+                X2 = entry["site"].specie.X
+
+                if isnan(X1) or isnan(X2):
+                    chemical_weight = 1
+                else:
+                    # note: 3.3 is max deltaX between 2 elements
+                    chemical_weight = 1 + self.x_diff_weight * sqrt(abs(X1 - X2) / 3.3)
+
+                entry["weight"] = entry["weight"] * chemical_weight
+
+        # sort nearest neighbors from highest to lowest weight
+        nn = sorted(nn, key=lambda x: x["weight"], reverse=True)
+        if nn[0]["weight"] == 0:
+            return self.transform_to_length(self.NNData([], {0: 1.0}, {0: []}), length)
+
+        # renormalize weights so the highest weight is 1.0
+        highest_weight = nn[0]["weight"]
+        for entry in nn:
+            entry["weight"] = entry["weight"] / highest_weight
+
+        # adjust solid angle weights based on distance
+        if self.distance_cutoffs:
+            r1 = _get_radius(structure[n])
+            for entry in nn:
+                r2 = _get_radius(entry["site"])
+                if r1 > 0 and r2 > 0:
+                    d = r1 + r2
+                else:
+                    warnings.warn(
+                        "CrystalNN: cannot locate an appropriate radius, "
+                        "covalent or atomic radii will be used, this can lead "
+                        "to non-optimal results."
+                    )
+                    d = _get_default_radius(structure[n]) + _get_default_radius(entry["site"])
+
+                dist = norm(structure[n].coords - entry["site"].coords)
+                dist_weight = 0
+
+                cutoff_low = d + self.distance_cutoffs[0]
+                cutoff_high = d + self.distance_cutoffs[1]
+
+                if dist <= cutoff_low:
+                    dist_weight = 1
+                elif dist < cutoff_high:
+                    dist_weight = (cos((dist - cutoff_low) / (cutoff_high - cutoff_low) * pi) + 1) * 0.5
+                entry["weight"] = entry["weight"] * dist_weight
+
+        # sort nearest neighbors from highest to lowest weight
+        nn = sorted(nn, key=lambda x: x["weight"], reverse=True)
+        if nn[0]["weight"] == 0:
+            return self.transform_to_length(self.NNData([], {0: 1.0}, {0: []}), length)
+
+        for entry in nn:
+            entry["weight"] = round(entry["weight"], 3)
+            del entry["poly_info"]  # trim
+
+        # remove entries with no weight
+        nn = [x for x in nn if x["weight"] > 0]
+
+        # get the transition distances, i.e. all distinct weights
+        dist_bins = []
+        for entry in nn:
+            if not dist_bins or dist_bins[-1] != entry["weight"]:
+                dist_bins.append(entry["weight"])
+        dist_bins.append(0)
+
+        # main algorithm to determine fingerprint from bond weights
+        cn_weights = {}  # CN -> score for that CN
+        cn_nninfo = {}  # CN -> list of nearneighbor info for that CN
+        for idx, val in enumerate(dist_bins):
+            if val != 0:
+                nn_info = []
+                for entry in nn:
+                    if entry["weight"] >= val:
+                        nn_info.append(entry)
+                cn = len(nn_info)
+                cn_nninfo[cn] = nn_info
+                cn_weights[cn] = self._semicircle_integral(dist_bins, idx)
+
+        # add zero coord
+        cn0_weight = 1.0 - sum(cn_weights.values())
+        if cn0_weight > 0:
+            cn_nninfo[0] = []
+            cn_weights[0] = cn0_weight
+
+        return self.transform_to_length(self.NNData(nn, cn_weights, cn_nninfo), length)
+
+
+class CrystalNNModifiedFingerprint(CrystalNNFingerprint):
+    """
+    CrystalNN coordination number fingerprint computed from the near
+    neighbor data of the whole structure (see StructureCrystalNN).
+    Only the "wt" order parameter is supported, i.e. the "cn" preset
+    of CrystalNNFingerprint, and chemical property weighting (chem_info)
+    is not.
+    Args:
+        op_types (dict): a dict of coordination number (int) to a list
+                         containing "wt"
+        chem_info (None): not supported, must be None
+        **kwargs: other settings to be passed into CrystalNN class
+    """
+
+    @staticmethod
+    def from_preset(preset, **kwargs):
+        if preset == "cn":
+            op_types = dict([(k + 1, ["wt"]) for k in range(24)])
+            return CrystalNNModifiedFingerprint(op_types, **kwargs)
+
+        raise RuntimeError('preset "{}" is not supported in '
+                           'CrystalNNModifiedFingerprint'.format(preset))
+
+    def __init__(self, op_types, chem_info=None, **kwargs):
+        if any(op != "wt" for t_list in op_types.values() for op in t_list):
+            raise ValueError('only "wt" order parameters are supported')
+        if chem_info is not None:
+            raise ValueError('chem_info is not supported')
+        super().__init__(op_types, **kwargs)
+        self.cnn = StructureCrystalNN(**kwargs)
+
+    def featurize(self, nndata):
+        """
+        Get crystal fingerprint of site from its near neighbor data.
+        Args:
+            nndata (NNData): CrystalNN near neighbor data of target site.
+        Returns:
+            list of coordination number weights of target site.
+        """
+        max_cn = sorted(self.op_types)[-1]
+        return [nndata.cn_weights.get(cn, 0)
+                for cn in range(1, max_cn + 1) if cn in self.ops
+                for _ in self.ops[cn]]
+
+    def featurize_structure(self, struct):
+        all_nndata = self.cnn.get_all_nn_data(struct)
+        features = [self.featurize(nndata) for nndata in all_nndata]
+        return features
@@ -1,11 +1,19 @@
-from os.path import join, dirname, abspath
-from numpy import mean
+from os import environ, getpid, makedirs, replace
+from os.path import join, dirname, abspath, exists, expanduser
+from functools import lru_cache
+from hashlib import blake2b
+from numpy import cumsum, empty, float32, vstack, zeros
+from numpy import load as numpy_load, save as numpy_save
+from joblib import Parallel, delayed
 from joblib import load as joblib_load
 from pickle import load as pickle_load
 from ase.io import read
 from pymatgen.io.ase import AseAtomsAdaptor
+from xgboost import DMatrix
+from xgboost.core import XGBoostError
 
-from ffp4mof.featurize import get_features
+from ffp4mof import __version__
+from ffp4mof.featurize import FEATURES_FORMAT, _FEATURE_WIDTHS, get_features
 
 
 AVAILABLE_FORCE_FIELD_PRECURSORS = [
@@ -28,35 +36,150 @@ LOG10_FORCE_FIELD_PRECURSORS = [
 ]
 
 
-def _get_ffp(features, ffp_type):
-    scaler = joblib_load(join(dirname(abspath(__file__)), "scalers", ffp_type, "scaler.gz"))
-    scaled_features = scaler.transform(features)
-    targets = []
+FEATURES_CACHE_DIR = environ.get("FFP4MOF_CACHE_DIR", join(expanduser("~"), ".cache", "ffp4mof"))
+
+
+@lru_cache(maxsize=None)
+def _gpu_available():
+    if environ.get("FFP4MOF_USE_GPU", "1") == "0":
+        return False
+
+    try:
+        from cupy.cuda.runtime import getDeviceCount
+        return getDeviceCount() > 0
+    except (ImportError, RuntimeError):
+        return False
+
+
+def _use_gpu_predictor(booster):
+    booster.set_param({"predictor": "gpu_predictor"})
+
+    # xgboost builds without CUDA support only fail once predict is called
+    try:
+        booster.predict(DMatrix(zeros((1, booster.num_features()))))
+    except XGBoostError:
+        booster.set_param({"predictor": "cpu_predictor"})
+
+
+@lru_cache(maxsize=None)
+def _load_scaler(ffp_type):
+    return joblib_load(join(dirname(abspath(__file__)), "scalers", ffp_type, "scaler.gz"))
+
+
+@lru_cache(maxsize=None)
+def _load_models(ffp_type):
+    models = []
 
     for i in range(5):
-        model = pickle_load(open(join(dirname(abspath(__file__)), "models", ffp_type, f"best_model_{i}.pickle"), "rb"))
-        targets.append(model.predict(scaled_features))
+        with open(join(dirname(abspath(__file__)), "models", ffp_type, f"best_model_{i}.pickle"), "rb") as model_file:
+            model = pickle_load(model_file)
+        if _gpu_available() and hasattr(model, "get_booster"):
+            _use_gpu_predictor(model.get_booster())
+        models.append(model)
+
+    return tuple(models)
 
-    targets = mean(targets, axis=0)
+
+def _get_ffp(features, ffp_type):
+    scaled_features = _load_scaler(ffp_type).transform(features)
+    models = _load_models(ffp_type)
+    targets = empty((len(models), scaled_features.shape[0]))
+
+    for i, model in enumerate(models):
+        targets[i] = model.predict(scaled_features)
+
+    targets = targets.mean(axis=0)
 
     return targets
 
 
-def get_ffps(filename, ffps_to_calc=None):
+def _get_cached_features(filename, structure):
+    with open(filename, "rb") as structure_file:
+        file_hash = blake2b(structure_file.read(), digest_size=20).hexdigest()
+    cache_path = join(FEATURES_CACHE_DIR, __version__, f"features_v{FEATURES_FORMAT}", f"{file_hash}.npy")
+
+    if exists(cache_path):
+        features = numpy_load(cache_path)
+        if features.dtype == float32 and features.shape == (len(structure), sum(_FEATURE_WIDTHS)):
+            return features
+
+    features = get_features(structure)
+    makedirs(dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{getpid()}.tmp"
+    with open(tmp_path, "wb") as cache_file:
+        numpy_save(cache_file, features)
+    replace(tmp_path, cache_path)
+
+    return features
+
+
+def _read_structure_features(filename, use_cache):
     a = AseAtomsAdaptor()
     structure = a.get_structure(read(filename))
+    features = _get_cached_features(filename, structure) if use_cache else get_features(structure)
+
+    return structure, features
+
+
+def _postprocess_ffp(ffp_values, ffp_type):
+    if ffp_type == "partial_charge":
+        ffp_values = ffp_values - sum(ffp_values) / ffp_values.size
+    if ffp_type in LOG10_FORCE_FIELD_PRECURSORS:
+        ffp_values = 10 ** (ffp_values)
+
+    return ffp_values
+
+
+def _save_structure(filename, structure):
     structure_name = filename.split("/")[-1][:-4]
-    features = get_features(structure)
-    ffps_dict = {}
+    structure.to("json", f"{structure_name}.json")
+
+
+def _add_ffps(structure, features, ffps_to_calc):
     ffps_to_calc = AVAILABLE_FORCE_FIELD_PRECURSORS if ffps_to_calc is None else ffps_to_calc
 
     for ffp_type in ffps_to_calc:
         assert ffp_type in AVAILABLE_FORCE_FIELD_PRECURSORS
-        ffp_values = _get_ffp(features, ffp_type)
-        if ffp_type == "partial_charge":
-            ffp_values = ffp_values - sum(ffp_values) / ffp_values.size
-        if ffp_type in LOG10_FORCE_FIELD_PRECURSORS:
-            ffp_values = 10 ** (ffp_values)
+        ffp_values = _postprocess_ffp(_get_ffp(features, ffp_type), ffp_type)
         structure.add_site_property(ffp_type, ffp_values.tolist())
-        
-    structure.to("json", f"{structure_name}.json")
+
+
+def get_ffps(filename, ffps_to_calc=None, use_cache=True):
+    structure, features = _read_structure_features(filename, use_cache)
+    _add_ffps(structure, features, ffps_to_calc)
+    _save_structure(filename, structure)
+
+
+def _read_all_structure_features(filenames, use_cache, n_jobs):
+    # workers only read and featurize; results are written from this process, so they land
+    # in its current directory (reused joblib workers keep the directory they started in)
+    return Parallel(n_jobs=n_jobs)(delayed(_read_structure_features)(filename, use_cache) for filename in filenames)
+
+
+def get_ffps_batch(filenames, ffps_to_calc=None, use_cache=True, n_jobs=-1):
+    structures_features = _read_all_structure_features(filenames, use_cache, n_jobs)
+
+    for filename, (structure, features) in zip(filenames, structures_features):
+        _add_ffps(structure, features, ffps_to_calc)
+        _save_structure(filename, structure)
+
+
+def get_ffps_batch_gpu(filenames, ffps_to_calc=None, use_cache=True, n_jobs=-1):
+    structures_features = _read_all_structure_features(filenames, use_cache, n_jobs)
+    if not structures_features:
+        return
+
+    structures, features = zip(*structures_features)
+    # features of all structures go through each model in a single predict call
+    bounds = cumsum([0] + [len(structure) for structure in structures])
+    features = vstack(features)
+    ffps_to_calc = AVAILABLE_FORCE_FIELD_PRECURSORS if ffps_to_calc is None else ffps_to_calc
+
+    for ffp_type in ffps_to_calc:
+        assert ffp_type in AVAILABLE_FORCE_FIELD_PRECURSORS
+        ffp_values = _get_ffp(features, ffp_type)
+        for structure, start, end in zip(structures, bounds[:-1], bounds[1:]):
+            structure.add_site_property(ffp_type, _postprocess_ffp(ffp_values[start:end], ffp_type).tolist())
+
+    for filename, structure in zip(filenames, structures):
+        _save_structure(filename, structure)
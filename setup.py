@@ -27,5 +27,6 @@ setuptools.setup(
         "pymatgen==2021.3.9",
         "matminer==0.6.5",
         "xgboost==1.1.1",
+        "numba==0.53.1",
     ],
 )